@@ -1,77 +1,176 @@
-import os, json, datetime, io, logging, subprocess
+import os, datetime, io, logging, subprocess, functools, time, asyncio, bisect
+from collections import OrderedDict
+from urllib.parse import quote
 from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, Request, HTTPException, Query, Response
+from fastapi import FastAPI, Request, HTTPException, Query, Response, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
-import uvicorn, requests
+from fastapi.responses import RedirectResponse, ORJSONResponse
+import uvicorn, httpx, orjson
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
-import qrcode
+from google.auth.transport.requests import Request as GoogleAuthRequest
+import segno
 from PIL import Image, ImageDraw, ImageFont
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%dT%H:%M:%SZ")
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 APP_PORT = 8091
 HA_URL = "http://supervisor/core/api"
 HA_TOKEN = os.environ.get("SUPERVISOR_TOKEN")
+SHEETS_URL = "https://sheets.googleapis.com"
+FAILED_SALES_PATH = "/data/failed_sales.jsonl"
+
+OPTIONS_PATH = "/data/options.json"
+
+# options.json only changes when the add-on is reconfigured, so it is parsed
+# again only when its mtime moves.
+@functools.lru_cache(maxsize=1)
+def _read_options_at(mtime: float) -> Dict[str, Any]:
+    with open(OPTIONS_PATH, "rb") as f:
+        return orjson.loads(f.read())
 
 def read_options() -> Dict[str, Any]:
-    with open("/data/options.json", "r", encoding="utf-8") as f:
-        return json.load(f)
+    return _read_options_at(os.path.getmtime(OPTIONS_PATH))
 
 def get_creds(sa_path: str):
     scopes = ["https://www.googleapis.com/auth/spreadsheets"]
     return service_account.Credentials.from_service_account_file(sa_path, scopes=scopes)
 
-def get_service(creds):
-    return build("sheets", "v4", credentials=creds, cache_discovery=False)
+# Credentials are reused across requests and reloaded only when the service
+# account file changes on disk.
+@functools.lru_cache(maxsize=1)
+def _creds(sa_path: str, mtime: float):
+    return get_creds(sa_path)
+
+def _credentials():
+    sa_path = read_options()["service_account_json"]
+    return _creds(sa_path, os.path.getmtime(sa_path))
+
+# One pooled client for all Sheets calls so concurrent requests share
+# connections and never block the event loop.
+_SHEETS = httpx.AsyncClient(http2=True, base_url=SHEETS_URL, timeout=30)
+_TOKEN_LOCK = asyncio.Lock()
+
+async def _auth_headers(force: bool = False) -> Dict[str, str]:
+    creds = _credentials()
+    if force or not creds.valid:
+        async with _TOKEN_LOCK:
+            if force or not creds.valid: await asyncio.to_thread(creds.refresh, GoogleAuthRequest())
+    return {"Authorization": f"Bearer {creds.token}"}
+
+async def _sheets_call(method: str, url: str, headers: Optional[Dict[str, str]] = None, **kw) -> Dict[str, Any]:
+    # A 401 means the token was revoked or expired early; refresh once and retry.
+    for force in (False, True):
+        r = await _SHEETS.request(method, url, headers={**await _auth_headers(force), **(headers or {})}, **kw)
+        if r.status_code != 401: break
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+async def sheet_get(sheet_id: str, rng: str) -> Dict[str, Any]:
+    return await _sheets_call("GET", f"/v4/spreadsheets/{sheet_id}/values/{quote(rng)}")
+
+async def sheet_append(sheet_id: str, rng: str, rows: List[List[Any]]) -> Dict[str, Any]:
+    return await _sheets_call("POST", f"/v4/spreadsheets/{sheet_id}/values/{quote(rng)}:append", params={"valueInputOption": "RAW"}, content=orjson.dumps({"values": rows}), headers={"Content-Type": "application/json"})
 
-def read_tab(service, sheet_id: str, tab: str) -> List[List[Any]]:
-    res = service.spreadsheets().values().get(spreadsheetId=sheet_id, range=f"{tab}!A:Z").execute()
+async def read_tab(sheet_id: str, tab: str) -> List[List[Any]]:
+    res = await sheet_get(sheet_id, f"{tab}!A:Z")
     return res.get("values", [])
 
 def to_dicts(rows: List[List[Any]]):
     if not rows: return []
-    headers = rows[0]
-    return [{h: (r[i] if i < len(r) else "") for i, h in enumerate(headers)} for r in rows[1:]]
+    headers = tuple(rows[0]); n = len(headers); pad = ("",) * n
+    return [dict(zip(headers, r if len(r) >= n else (*r, *pad[len(r):]))) for r in rows[1:]]
+
+def to_columns(rows: List[List[Any]]):
+    # Column-wise tuples (one per header) instead of a dict per row.
+    if not rows: return (), ()
+    headers = tuple(rows[0]); n = len(headers); pad = ("",) * n
+    cols = tuple(zip(*(r if len(r) >= n else (*r, *pad[len(r):]) for r in rows[1:])))[:n]
+    return headers, cols or tuple(() for _ in headers)
+
+# Short-lived cache of each tab's lookup tables, so repeated lookups within a
+# request (and across bursts of requests) do not each cost a Sheets round-trip.
+# Only the derived form is kept; the raw rows are dropped once indexed.
+_TAB_TTL = 20.0
+_TAB_CACHE: Dict[tuple, tuple] = {}
+
+async def tab_index(sheet_id: str, tab: str, build_index):
+    key = (sheet_id, tab); hit = _TAB_CACHE.get(key)
+    if hit and time.monotonic() - hit[0] < _TAB_TTL: return hit[1]
+    index = build_index(await read_tab(sheet_id, tab))
+    _TAB_CACHE[key] = (time.monotonic(), index)
+    return index
+
+def invalidate_tab(sheet_id: str, tab: str):
+    _TAB_CACHE.pop((sheet_id, tab), None)
+
+def _index_users(rows):
+    by_id = {}
+    for u in to_dicts(rows): by_id.setdefault(u.get("user_id"), u)
+    return by_id
+
+def _index_products(rows):
+    by_id, by_short = {}, {}
+    for p in to_dicts(rows):
+        by_id.setdefault(p.get("product_id"), p); by_short.setdefault(p.get("short_id"), p)
+    return by_id, by_short
+
+def _index_stock(rows):
+    headers, cols = to_columns(rows)
+    by_reseller = {}
+    if "reseller_id" in headers:
+        for i, rid in enumerate(cols[headers.index("reseller_id")]): by_reseller.setdefault(rid, []).append(i)
+    return headers, cols, by_reseller
 
-def lookup_user(service, sheet_id: str, user_id: Optional[str]):
+def stock_items(stock, positions: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+    headers, cols, _ = stock
+    if positions is None: positions = range(len(cols[0]) if cols else 0)
+    return [dict(zip(headers, (c[i] for c in cols))) for i in positions]
+
+def _parse_date(value: str, default: datetime.date) -> datetime.date:
+    try: return datetime.date.fromisoformat(value) if value else default
+    except ValueError: return default
+
+def _index_pricing(rows):
+    # Each group holds (valid_from, valid_to, row) as date ordinals sorted by
+    # valid_from, plus the valid_from ordinals on their own for bisecting.
+    groups = {}
+    for r in to_dicts(rows):
+        vf = _parse_date(r.get("valid_from",""), datetime.date(1970,1,1)).toordinal()
+        vt = _parse_date(r.get("valid_to",""), datetime.date(9999,12,31)).toordinal()
+        groups.setdefault((r.get("reseller_id"), r.get("product_id")), []).append((vf, vt, r))
+    for k, g in groups.items():
+        g.sort(key=lambda e: e[0]); groups[k] = ([e[0] for e in g], g)
+    return groups
+
+async def lookup_user(sheet_id: str, user_id: Optional[str]):
     if not user_id: return {}
-    for u in to_dicts(read_tab(service, sheet_id, "Users")):
-        if u.get("user_id") == user_id: return u
+    return (await tab_index(sheet_id, "Users", _index_users)).get(user_id, {})
+
+async def lookup_product(sheet_id: str, product_id: Optional[str]=None, short_id: Optional[str]=None):
+    by_id, by_short = await tab_index(sheet_id, "Products", _index_products)
+    if product_id and product_id in by_id: return by_id[product_id]
+    if short_id and short_id in by_short: return by_short[short_id]
     return {}
 
-def lookup_product(service, sheet_id: str, product_id: Optional[str]=None, short_id: Optional[str]=None):
-    for p in to_dicts(read_tab(service, sheet_id, "Products")):
-        if product_id and p.get("product_id") == product_id: return p
-        if short_id and p.get("short_id") == short_id: return p
+async def lookup_reseller_price(sheet_id: str, reseller_id: str, product_id: str, on_date: Optional[datetime.date]=None):
+    vfs, group = (await tab_index(sheet_id, "ResellerPricing", _index_pricing)).get((reseller_id, product_id), ([], []))
+    on = (on_date or datetime.date.today()).toordinal()
+    # Newest row starting on or before the date wins; walk back past expired ones.
+    for i in range(bisect.bisect_right(vfs, on) - 1, -1, -1):
+        if on <= group[i][1]: return group[i][2]
     return {}
 
-def lookup_reseller_price(service, sheet_id: str, reseller_id: str, product_id: str, on_date: Optional[datetime.date]=None):
-    rows = to_dicts(read_tab(service, sheet_id, "ResellerPricing"))
-    if on_date is None: on_date = datetime.date.today()
-    best = {}
-    for r in rows:
-        if r.get("reseller_id") != reseller_id or r.get("product_id") != product_id: continue
-        vf = r.get("valid_from",""); vt = r.get("valid_to","")
-        try: vf_date = datetime.date.fromisoformat(vf) if vf else datetime.date(1970,1,1)
-        except: vf_date = datetime.date(1970,1,1)
-        try: vt_date = datetime.date.fromisoformat(vt) if vt else datetime.date(9999,12,31)
-        except: vt_date = datetime.date(9999,12,31)
-        if vf_date <= on_date <= vt_date:
-            if not best or vf_date >= datetime.date.fromisoformat(best.get("valid_from","1970-01-01")): best = r
-    return best
-
-def fire_event(event_name: str, payload: Dict[str, Any]):
-    token = os.environ.get("SUPERVISOR_TOKEN")
-    if not token: 
+# Keep-alive client so each sale reuses the connection to the supervisor.
+_HA = httpx.AsyncClient(base_url=HA_URL, headers={"Authorization": f"Bearer {HA_TOKEN}", "Content-Type": "application/json"}, limits=httpx.Limits(max_connections=4), timeout=5)
+
+async def fire_event(event_name: str, payload: Dict[str, Any]):
+    if not HA_TOKEN:
         logging.info("No SUPERVISOR_TOKEN. Skipping HA event.")
         return
-    url = f"{HA_URL}/events/{event_name}"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
     try:
-        r = requests.post(url, headers=headers, data=json.dumps(payload), timeout=5)
+        r = await _HA.post(f"/events/{event_name}", content=orjson.dumps(payload))
         logging.info(f"HA event fired {event_name}: {r.status_code}")
     except Exception as e:
         logging.error(f"HA event error: {e}")
@@ -88,7 +187,40 @@ def git_clone_or_pull(repo_url, target_dir="/data/repo"):
     except Exception as e:
         logging.error(f"git error: {e}")
 
-app = FastAPI()
+async def _persist_sale(o: Dict[str, Any], row: List[Any], event: Dict[str, Any]):
+    # Runs after the response is sent; rows that cannot be written are kept
+    # in FAILED_SALES_PATH so they can be re-entered by hand.
+    try:
+        await sheet_append(o["google_sheet_id"], "Sales!A:Z", [row])
+        invalidate_tab(o["google_sheet_id"], "Sales")
+    except Exception as e:
+        logging.error(f"Sales append error: {e}")
+        try:
+            with open(FAILED_SALES_PATH, "ab") as f: f.write(orjson.dumps(row) + b"\n")
+        except Exception as e2:
+            logging.error(f"Could not record failed sale {row}: {e2}")
+        return
+    await fire_event(o.get("ha_event","pos_sale"), event)
+
+# Rendered labels keyed by product_id and the product row, so an edited row
+# renders afresh while repeat prints are served from memory.
+_LABEL_CACHE: "OrderedDict[tuple, bytes]" = OrderedDict()
+_LABEL_CACHE_MAX = 256
+_LABEL_FONT = ImageFont.load_default()
+_LABEL_TEMPLATE = Image.new("RGB", (400, 300), "white")
+# render_label only runs on the event loop thread, so one buffer is enough.
+_LABEL_BUF = io.BytesIO()
+
+def render_label(prod: Dict[str, Any]) -> bytes:
+    label_text = f"{prod.get('short_id','')} - {prod.get('name','')}\nSize: {prod.get('package_size','')}\nPrice: {prod.get('base_price','')} NOK\nProducer: {prod.get('producer','')}"
+    qr = segno.make_qr(orjson.dumps({"product_id": prod.get("product_id"), "short_id": prod.get("short_id")}).decode(), error="m", boost_error=False)
+    w, h = qr.symbol_size(scale=1, border=2)
+    qr_img = Image.frombytes("L", (w, h), bytes(0 if dark else 255 for row in qr.matrix_iter(scale=1, border=2) for dark in row)).resize((w * 4, h * 4), Image.NEAREST)
+    img = _LABEL_TEMPLATE.copy(); d = ImageDraw.Draw(img); d.text((10, 10), label_text, fill="black", font=_LABEL_FONT); img.paste(qr_img, (250, 50))
+    _LABEL_BUF.seek(0); _LABEL_BUF.truncate(0); img.save(_LABEL_BUF, format="PNG", compress_level=1)
+    return _LABEL_BUF.getvalue()
+
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 app.mount("/ui", StaticFiles(directory="static", html=True), name="ui")
 app.mount("/pos", StaticFiles(directory="static", html=True), name="pos")
@@ -110,58 +242,61 @@ def on_start():
         logging.info("No options.json or git_repo not set")
     logging.info("Startup complete")
 
+@app.on_event("shutdown")
+async def on_stop():
+    await _SHEETS.aclose(); await _HA.aclose()
+
 @app.get("/pos/stock")
-def get_stock(reseller_id: str = Query(None), user_id: str = Query(None)):
-    o = read_options(); s = get_service(get_creds(o["service_account_json"]))
-    items = to_dicts(read_tab(s, o["google_sheet_id"], "Stock"))
+async def get_stock(reseller_id: str = Query(None), user_id: str = Query(None)):
+    o = read_options()
+    stock, u = await asyncio.gather(tab_index(o["google_sheet_id"], "Stock", _index_stock), lookup_user(o["google_sheet_id"], user_id))
+    positions = None
     if user_id:
-        u = lookup_user(s, o["google_sheet_id"], user_id); rid = u.get("user_id") if u else None
-        if rid: items = [x for x in items if x.get("reseller_id") == rid]
+        rid = u.get("user_id") if u else None
+        if rid: positions = stock[2].get(rid, [])
     elif reseller_id:
-        items = [x for x in items if x.get("reseller_id") == reseller_id]
-    return items
+        positions = stock[2].get(reseller_id, [])
+    return stock_items(stock, positions)
 
 @app.post("/pos/sale")
-async def pos_sale(req: Request):
-    p = await req.json()
+async def pos_sale(req: Request, bg: BackgroundTasks):
+    p = orjson.loads(await req.body())
     user_id = p.get("user_id",""); reseller_id = p.get("reseller_id","")
     product_id = p.get("product_id"); short_id = p.get("short_id")
     qty = int(p.get("qty",1)); customer_id = p.get("customer_id","C-000")
     payment_method = p.get("payment_method","cash")
     if not product_id and not short_id:
         raise HTTPException(status_code=400, detail="product_id or short_id required")
-    o = read_options(); s = get_service(get_creds(o["service_account_json"]))
-    prod = lookup_product(s, o["google_sheet_id"], product_id, short_id)
+    o = read_options(); now = datetime.datetime.now()
+    # Fetch both tabs concurrently; the lookups below are then served from cache.
+    await asyncio.gather(tab_index(o["google_sheet_id"], "Products", _index_products), tab_index(o["google_sheet_id"], "ResellerPricing", _index_pricing))
+    prod = await lookup_product(o["google_sheet_id"], product_id, short_id)
     if not prod: raise HTTPException(status_code=404, detail="Product not found")
     product_id = prod.get("product_id"); short_id = prod.get("short_id")
-    rp = lookup_reseller_price(s, o["google_sheet_id"], reseller_id, product_id)
+    rp = await lookup_reseller_price(o["google_sheet_id"], reseller_id, product_id, now.date())
     try: price = float(rp.get("price") or prod.get("base_price") or 0)
     except: price = float(prod.get("base_price") or 0)
     try: commission_pct = float(rp.get("commission_pct") or 0)
     except: commission_pct = 0.0
     total = price * qty
-    row = [datetime.datetime.now().isoformat(), user_id, "", customer_id, product_id, short_id, qty, price, commission_pct, total, payment_method]
-    s.spreadsheets().values().append(spreadsheetId=o["google_sheet_id"], range="Sales!A:Z", valueInputOption="RAW", body={"values": [row]}).execute()
-    fire_event(o.get("ha_event","pos_sale"), {"user_id":user_id,"reseller_id":reseller_id,"customer_id":customer_id,"total":total,"product_id":product_id,"qty":qty})
+    row = [now.isoformat(), user_id, "", customer_id, product_id, short_id, qty, price, commission_pct, total, payment_method]
+    bg.add_task(_persist_sale, o, row, {"user_id":user_id,"reseller_id":reseller_id,"customer_id":customer_id,"total":total,"product_id":product_id,"qty":qty})
     return {"status":"ok","total":total}
 
 @app.get("/pos/label/{product_id}")
-def generate_label(product_id: str):
-    o = read_options(); s = get_service(get_creds(o["service_account_json"]))
-    products = to_dicts(read_tab(s, o["google_sheet_id"], "Products"))
-    prod = next((p for p in products if p.get("product_id") == product_id), None)
+async def generate_label(product_id: str):
+    o = read_options()
+    prod = (await tab_index(o["google_sheet_id"], "Products", _index_products))[0].get(product_id)
     if not prod: raise HTTPException(status_code=404, detail="Product not found")
-    import qrcode
-    from PIL import Image, ImageDraw, ImageFont
-    label_text = f"{prod.get('short_id','')} - {prod.get('name','')}\nSize: {prod.get('package_size','')}\nPrice: {prod.get('base_price','')} NOK\nProducer: {prod.get('producer','')}"
-    qr = qrcode.QRCode(box_size=4, border=2); qr.add_data(json.dumps({"product_id": prod.get("product_id"), "short_id": prod.get("short_id")})); qr.make(fit=True)
-    qr_img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
-    img = Image.new("RGB", (400, 300), "white"); d = ImageDraw.Draw(img); d.text((10, 10), label_text, fill="black", font=ImageFont.load_default()); img.paste(qr_img, (250, 50))
-    import io
-    buf = io.BytesIO(); img.save(buf, format="PNG"); buf.seek(0)
-    from fastapi import Response
-    return Response(content=buf.getvalue(), media_type="image/png")
+    key = (product_id, hash(tuple(prod.items())))
+    png = _LABEL_CACHE.get(key)
+    if png is None:
+        png = render_label(prod); _LABEL_CACHE[key] = png
+        if len(_LABEL_CACHE) > _LABEL_CACHE_MAX: _LABEL_CACHE.popitem(last=False)
+    else:
+        _LABEL_CACHE.move_to_end(key)
+    return Response(content=png, media_type="image/png")
 
 if __name__ == "__main__":
     logging.info("Starting Uvicorn on 0.0.0.0:8091")
-    uvicorn.run("run:app", host="0.0.0.0", port=APP_PORT)
+    uvicorn.run("run:app", host="0.0.0.0", port=APP_PORT, loop="uvloop", http="httptools")
@@ -1,4 +1,4 @@
-import os, time, json, logging, subprocess
+import os, sys, json, signal, logging, subprocess
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%dT%H:%M:%SZ")
 
 def git_clone_or_pull(url, target="/data/repo"):
@@ -21,7 +21,8 @@ try:
 except Exception:
     pass
 
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 logging.info("Service started")
+# Nothing left to do after the pull; sleep until the supervisor stops us.
 while True:
-    logging.info("heartbeat")
-    time.sleep(300)
+    signal.pause()
\ No newline at end of file